@@ -8,6 +8,7 @@ import ipywidgets as widgets
 import pandas as pd
 import requests
 from bqplot import Axis, DateScale, Figure, LinearScale, Lines
+from granules import parse_granule_names, rank_granules
 from ipyleaflet import DrawControl, GeoJSON, LayersControl, Map
 from IPython.display import display
 from pqdm.threads import pqdm
@@ -40,6 +41,7 @@ class map():
             'hemisphere': hemisphere,
             'orientation': orientation,
             'max_granules_per_year': 1000,
+            'rank_by': None,
             'project_name': 'default',
             'selected_months': []
         }
@@ -161,11 +163,24 @@ class map():
                    'display': 'flex-start',
                    'description_width': 'initial'}
         )
+        self._control_rank_by = widgets.Dropdown(
+            options=[('API order', None),
+                     ('Valid pixels', 'valid_pixels')],
+            value=self.properties['rank_by'],
+            description='Keep first by:',
+            disabled=False,
+            style={'max_width': '40px',
+                   'display': 'flex-start',
+                   'description_width': 'initial'}
+        )
         self._control_filters = widgets.Accordion(children=[
             widgets.HBox([
                 self._control_filter_button,
                 self._control_selected_months,
-                self._control_max_files_per_year,
+                widgets.VBox([
+                    self._control_max_files_per_year,
+                    self._control_rank_by
+                ])
         ])], selected_index=None)
         self._control_selected_granules =  widgets.Label(
             value=f'Selected Granules: {len(self.filtered_urls)}'
@@ -235,6 +250,7 @@ class map():
             'geometry': self.properties['geometry'],
             'hemisphere': self._control_projection.value,
             'max_granules_per_year': int(self._control_max_files_per_year.value),
+            'rank_by': self._control_rank_by.value,
             'selected_months': self._control_selected_months.value,
             'orientation': self.properties['orientation'],
             'project_name': self.properties['project_name']
@@ -282,7 +298,8 @@ class map():
                 max_files_per_year = int(self._control_max_files_per_year.value)
             filtered_urls = self.filter_urls(self.granule_urls,
                                              months=months,
-                                             max_files_per_year=max_files_per_year)
+                                             max_files_per_year=max_files_per_year,
+                                             rank_by=self._control_rank_by.value)
             self._control_selected_granules.value = f'Selected Granules: {len(self.filtered_urls)}'
 
             years = []
@@ -300,22 +317,6 @@ class map():
             self._control_filters.selected_index = None
 
 
-    def _get_temporal_coverage(self, url):
-        file_name = url.split('/')[-1].replace('.nc', '')
-        file_components = file_name.split('_')
-        start_date = datetime.strptime(file_components[11], "%Y%m%d").date()
-        end_date = datetime.strptime(file_components[3], "%Y%m%d").date()
-        mid_date = start_date + (end_date - start_date) / 2
-
-        coverage = {
-            'url': url,
-            'start': start_date,
-            'end': end_date,
-            'mid_date': mid_date
-        }
-        return coverage
-
-
     def _fetch_granule_counts(self, e):
         if self.properties['geometry'] is None:
             return None
@@ -380,9 +381,10 @@ class map():
     # Public functions
 
     @staticmethod
-    def Search(params: dict):
+    def Search(params: dict, catalog=None):
         """
         params:
+            - catalog: optional GranuleCatalog, if given the query is answered locally without the API
             - params: dictionary with ITS_LIVE API parameters
                 bbox or polygon: defines the area
                 start: start time YYYY-mm-dd
@@ -404,6 +406,8 @@ class map():
               }
               granules = SearchWidget.search(params)
         """
+        if catalog is not None:
+            return catalog.search(params)
         if 'polygon' in params:
             geometry_query = f"polygon={params['polygon']}&"
         else:
@@ -436,7 +440,11 @@ class map():
                     urls: list=None,
                     max_files_per_year: int=None,
                     months: list=None,
-                    by_year: bool=True):
+                    by_year: bool=True,
+                    rank_by: list=None,
+                    max_files_per_month: int=None,
+                    preferred_separation: tuple=None,
+                    preferred_sensors: list=None):
         """
         Helper functio to filter a list of URLS from ITS_LIVE on witch the mid-date matches the months given
         in the `months` parameter up to a max number of files per year. i.e. if we have a list of 12 files on 2009
@@ -446,41 +454,41 @@ class map():
             - urls: array of ITS_LIVE urls
             - max_files_per_year: int, max number of files per year even if they fall into the correct months
             - months: array of named months of the year, i.e. ['January', 'December']
+            - rank_by: criteria used to pick which files are kept when a max is applied, in priority order.
+              None keeps the first files in API order, otherwise any of:
+                'sensor': files from preferred_sensors first, in the given order
+                'separation': files with a separation inside preferred_separation first, then the closest to it
+                'valid_pixels': files with the highest valid pixel percentage first
+            - max_files_per_month: int, max number of files per month, applied before max_files_per_year
+            - preferred_separation: (min, max) days between image pairs, used by rank_by='separation'
+            - preferred_sensors: array of sensors, i.e. ['LC08', 'LE07'], used by rank_by='sensor'
         returns:
             - if by_year is true returns a dictionary with years as keys and ITS_LIVE urls as values for each year
               if by_year is false, returns a flat list of urls that satisfy the filter parameters
         """
-        # LE07_L1TP_008012_20030417_20170125_01_T1_X_LE07_L1TP_008012_20030401_20170126_01_T1_G0240V01_P095.nc
         if urls is None:
             return None
-        filtered_urls = []
-        year_counts = {}
-
-        for url in urls:
-            coverage = self._get_temporal_coverage(url)
-            if months is not None and len(months) > 0:
-                if coverage['mid_date'].strftime("%B") in months or coverage['mid_date'].strftime("%b") in months:
-                    if str(coverage['mid_date'].year) not in year_counts:
-                        year_counts[str(coverage['mid_date'].year)] = [url]
-                        filtered_urls.append(url)
-                    else:
-                        if len(year_counts[str(coverage['mid_date'].year)]) < max_files_per_year:
-                            filtered_urls.append(url)
-                            year_counts[str(coverage['mid_date'].year)].append(url)
-                        else:
-                            continue
-            else:
-                if str(coverage['mid_date'].year) not in year_counts:
-                        year_counts[str(coverage['mid_date'].year)] = [url]
-                        filtered_urls.append(url)
-                else:
-                    if len(year_counts[str(coverage['mid_date'].year)]) < max_files_per_year:
-                        filtered_urls.append(url)
-                        year_counts[str(coverage['mid_date'].year)].append(url)
-                    else:
-                        continue
-        self.filtered_urls = filtered_urls
-        self.filtered_urls_by_year = dict(sorted(year_counts.items()))
+        granules = parse_granule_names(urls)
+        if months is not None and len(months) > 0:
+            month_names = granules['mid_date'].dt.month_name()
+            granules = granules[month_names.isin(months) | month_names.str[:3].isin(months)]
+
+        granules = rank_granules(granules,
+                                 rank_by=rank_by,
+                                 preferred_separation=preferred_separation,
+                                 preferred_sensors=preferred_sensors)
+
+        year = granules['mid_date'].dt.year
+        if max_files_per_month:
+            granules = granules.groupby([year, granules['mid_date'].dt.month], sort=False).head(max_files_per_month)
+            year = granules['mid_date'].dt.year
+        if max_files_per_year:
+            granules = granules.groupby(year, sort=False).head(max_files_per_year)
+        granules = granules.sort_index()
+
+        self.filtered_urls = granules['url'].tolist()
+        self.filtered_urls_by_year = {str(y): group.tolist() for y, group in
+                                      granules['url'].groupby(granules['mid_date'].dt.year)}
 
         if by_year:
             return self.filtered_urls_by_year
@@ -1,7 +1,13 @@
 import gc
+import json
 import logging
 import operator
+import os
+import re
+import shutil
+import warnings
 from glob import glob
+from uuid import uuid4
 
 import geojson
 import geopandas
@@ -9,7 +15,10 @@ import numpy as np
 import pandas as pd
 import rioxarray
 import xarray as xr
-from shapely.geometry import Polygon, box
+from granules import parse_granule_names, rank_granules
+from joblib import Parallel, delayed
+from rasterio.features import geometry_mask
+from shapely.geometry import Polygon, box, shape
 
 logger = logging.getLogger('PROCESSING')
 
@@ -43,20 +52,161 @@ class VelocityProcessing:
             'coordinates': [coords]
         }
 
+    @staticmethod
+    def _grid_offset(coords: np.ndarray, resolution: float, factor: int):
+        """
+        returns the index of the first pixel that falls on the global grid of factor * resolution,
+        so granules with different extents on the same native grid keep the same coarse pixels.
+        """
+        step = 1 if coords[1] > coords[0] else -1
+        first = int(np.floor(round(float(coords[0]) / resolution, 6)))
+        return (-step * first) % factor
+
+    @staticmethod
+    def _decimate(ds: xr.Dataset, target_resolution: float=None, resampling: str='stride'):
+        """
+        returns a reduced-resolution view of a granule, aligned to a global grid of target_resolution
+        so decimated granules stack without interleaving.
+        params:
+            - ds: lazily opened granule
+            - target_resolution: pixel size in meters, i.e. 1200 reads 1 in 5 pixels of a 240 m granule
+            - resampling: 'stride' keeps every n-th pixel and only reads those,
+              'mean' block-averages n x n windows, it reads the whole granule unless it is opened with dask chunks
+        """
+        if target_resolution is None:
+            return ds
+        native_resolution = abs(float(ds.x[1] - ds.x[0]))
+        factor = int(round(target_resolution / native_resolution))
+        if factor <= 1:
+            return ds
+        x_start = VelocityProcessing._grid_offset(ds.x.values, native_resolution, factor)
+        y_start = VelocityProcessing._grid_offset(ds.y.values, native_resolution, factor)
+        if resampling == 'stride':
+            return ds.isel(x=slice(x_start, None, factor), y=slice(y_start, None, factor))
+        elif resampling == 'mean':
+            ds = ds.isel(x=slice(x_start, None), y=slice(y_start, None))
+            return ds.coarsen(x=factor, y=factor, boundary='trim').mean(keep_attrs=True)
+        raise ValueError(f'Unknown resampling method: {resampling}')
+
+    @staticmethod
+    def _clip(ds: xr.Dataset, clip_geom: dict, projection: int, geometries: dict, masks: dict):
+        """
+        clips a granule to clip_geom, equivalent to ds.rio.clip([clip_geom], crs='epsg:4326').
+        Granules share a handful of grids, so the reprojected geometry is cached per CRS and the
+        pixel window and mask per (CRS, transform, shape), later granules only slice and mask.
+        params:
+            - ds: granule with its CRS written
+            - clip_geom: GeoJSON geometry in EPSG:4326
+            - projection: EPSG code of the granule
+            - geometries: cache of reprojected geometries, updated in place
+            - masks: cache of pixel windows and masks, updated in place
+        """
+        if projection not in geometries:
+            geometries[projection] = geopandas.GeoSeries([shape(clip_geom)],
+                                                         crs='epsg:4326').to_crs(epsg=projection).iloc[0]
+        transform = ds.rio.transform()
+        grid = (projection, tuple(transform)[:6], (ds.sizes['y'], ds.sizes['x']))
+        if grid not in masks:
+            mask = geometry_mask([geometries[projection]],
+                                 out_shape=grid[2],
+                                 transform=transform,
+                                 invert=True)
+            rows = np.flatnonzero(mask.any(axis=1))
+            cols = np.flatnonzero(mask.any(axis=0))
+            if len(rows) == 0:
+                masks[grid] = None
+            else:
+                window = {'y': slice(rows[0], rows[-1] + 1), 'x': slice(cols[0], cols[-1] + 1)}
+                window_mask = xr.DataArray(mask[window['y'], window['x']], dims=('y', 'x'))
+                masks[grid] = (window, window_mask)
+        if masks[grid] is None:
+            raise ValueError('No data found in bounds.')
+        window, window_mask = masks[grid]
+        clipped = ds.isel(window)
+        with xr.set_options(keep_attrs=True):
+            for var in clipped.data_vars:
+                # Same fill as rio.clip: nodata if there is one, integer variables keep their dtype
+                data = clipped[var]
+                nodata = ds[var].rio.nodata
+                if nodata is not None and not np.isnan(nodata):
+                    clipped[var] = data.where(window_mask, nodata)
+                elif np.issubdtype(data.dtype, np.integer):
+                    clipped[var] = data.where(window_mask, 0)
+                else:
+                    clipped[var] = data.where(window_mask)
+                clipped[var] = clipped[var].astype(data.dtype)
+        return clipped.rio.write_crs(projection)
+
+    @staticmethod
+    def _dedupe_paths(paths: list, duplicates: str='first', preferred_sensors: list=None):
+        """
+        keeps one granule per mid-date using the fields in the file names, before anything is opened.
+        params:
+            - paths: sorted granule paths
+            - duplicates: which granule to keep for a repeated mid-date
+                'first': the first one in file name order
+                'valid_pixels': the one with the highest valid pixel percentage
+                'separation': the one with the shortest separation between images
+                'sensor': the first one in preferred_sensors
+            - preferred_sensors: array of sensors, i.e. ['LC08', 'LE07']
+        """
+        policies = {
+            'first': [],
+            'valid_pixels': ['valid_pixels'],
+            'separation': ['separation', 'valid_pixels'],
+            'sensor': ['sensor', 'valid_pixels']
+        }
+        if duplicates not in policies:
+            raise ValueError(f'Unknown duplicates policy: {duplicates}, use one of {list(policies)}')
+        try:
+            granules = parse_granule_names(paths)
+        except (KeyError, ValueError) as e:
+            logger.warning(f'Granule names could not be parsed, repeated mid-dates are resolved on open: {e}')
+            return paths
+        granules = rank_granules(granules,
+                                 rank_by=policies[duplicates],
+                                 preferred_separation=(0, 0),
+                                 preferred_sensors=preferred_sensors)
+        kept = granules.drop_duplicates('mid_date', keep='first').sort_index()
+        if len(kept) < len(paths):
+            logger.info(f'Skipping {len(paths) - len(kept)} granules with repeated mid-dates')
+        return kept['url'].tolist()
+
     @staticmethod
     def load_cube(directory: str=None,
                   clip_geom: dict=None,
-                  include_all_projections: bool=False):
-        mid_date = []
+                  include_all_projections: bool=False,
+                  target_resolution: float=None,
+                  resampling: str='stride',
+                  duplicates: str='first',
+                  preferred_sensors: list=None):
+        """
+        clips and stacks the granules in a directory into a time cube.
+        params:
+            - directory: glob pattern of the granules, i.e. data/pine-glacier/*.nc
+            - clip_geom: GeoJSON geometry of the region of interest in EPSG:4326
+            - include_all_projections: if True reprojects and merges the 2 most common projections
+            - target_resolution: pixel size in meters for quick-look cubes, None keeps the native resolution
+            - resampling: 'stride' or 'mean', how granules are reduced to target_resolution
+            - duplicates: 'first', 'valid_pixels', 'separation' or 'sensor', which granule is kept for a repeated mid-date
+            - preferred_sensors: array of sensors in order of preference, used by duplicates='sensor'
+        returns:
+            - an xarray dataset with the clipped layers stacked on the time dimension
+        """
+        mid_date = set()
         clipped_geometries = []
-        paths = sorted(glob(directory))
+        geometries = {}
+        masks = {}
+        paths = VelocityProcessing._dedupe_paths(sorted(glob(directory)), duplicates, preferred_sensors)
         datasets = [xr.open_dataset(p) for p in paths]
 
         for ds in datasets:
             ds.coords['time'] = pd.to_datetime(ds.img_pair_info.date_center)
+            # Days between the image pair, used to weight and resample the layers
+            ds.coords['date_dt'] = float(ds.img_pair_info.date_dt)
             # Keeps track of repeated mid-dates
             if ds.img_pair_info.date_center not in mid_date:
-                mid_date.append(ds.img_pair_info.date_center)
+                mid_date.add(ds.img_pair_info.date_center)
                 if 'UTM_Projection' in ds:
                     proj_var = 'UTM_Projection'
                     projection = int(ds.UTM_Projection.spatial_epsg)
@@ -65,9 +215,10 @@ class VelocityProcessing:
                     projection = int(ds.Polar_Stereographic.spatial_epsg)
 
                 ds = ds.drop_vars(['img_pair_info', proj_var])
+                ds = VelocityProcessing._decimate(ds, target_resolution, resampling)
                 ds = ds.rio.write_crs(projection)
                 try:
-                    clipped_geom = ds.rio.clip([clip_geom], crs='epsg:4326')
+                    clipped_geom = VelocityProcessing._clip(ds, clip_geom, projection, geometries, masks)
                     # Keep only those layers with some velocity information
                     if not np.isnan(clipped_geom.v.max().values):
                         clipped_geometries.append(clipped_geom)
@@ -111,6 +262,422 @@ class VelocityProcessing:
         less_common_reprojected.vy.values[less_common_reprojected.vy.values < 0] = np.nan
         return xr.concat([less_common_reprojected, stacked_projections[most_common_key]], dim='time')
 
+    @staticmethod
+    def _weighted_polyfit(y: np.ndarray, w: np.ndarray, t: np.ndarray, deg: int=1):
+        """
+        closed-form weighted least squares of y = c0 + c1*t + ... + cn*t^n for every pixel at once.
+        params:
+            - y: array with time as the last axis, NaN marks a gap
+            - w: weights broadcastable to y
+            - t: 1d array of times
+            - deg: polynomial degree
+        returns:
+            - coefficients (..., deg + 1), r2 (...), count (...)
+        """
+        valid = np.isfinite(y) & np.isfinite(w)
+        w = np.where(valid, w, 0.0)
+        y = np.where(valid, y, 0.0)
+        count = valid.sum(axis=-1)
+        # Weights normalized per pixel, only their relative size matters for the fit
+        total_w = w.sum(axis=-1, keepdims=True)
+        w = np.divide(w, total_w, out=np.zeros_like(w, dtype=float), where=total_w > 0)
+        # Normal equations: sum(w * t^(i+j)) c = sum(w * t^i * y)
+        powers = t[:, None] ** np.arange(2 * deg + 1)
+        moments = w @ powers
+        idx = np.arange(deg + 1)
+        lhs = moments[..., idx[:, None] + idx[None, :]]
+        rhs = (w * y) @ powers[:, :deg + 1]
+        solvable = count > deg
+        lhs[~solvable] = np.eye(deg + 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            solvable &= np.linalg.cond(lhs) < 1 / np.finfo(float).eps
+        lhs[~solvable] = np.eye(deg + 1)
+        coefficients = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+        coefficients[~solvable] = np.nan
+
+        fitted = coefficients @ powers[:, :deg + 1].T
+        total_w = w.sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_y = (w * y).sum(axis=-1) / total_w
+            ss_res = (w * (y - fitted) ** 2).sum(axis=-1)
+            ss_tot = (w * (y - mean_y[..., None]) ** 2).sum(axis=-1)
+            r2 = np.where(solvable, 1 - ss_res / ss_tot, np.nan)
+        return coefficients, r2, count
+
+    @staticmethod
+    def _trend_kernel(y: np.ndarray, w: np.ndarray, t: np.ndarray):
+        linear, r2, count = VelocityProcessing._weighted_polyfit(y, w, t, deg=1)
+        quadratic, _, _ = VelocityProcessing._weighted_polyfit(y, w, t, deg=2)
+        return linear[..., 1], 2 * quadratic[..., 2], r2, count
+
+    @staticmethod
+    def velocity_trend(cube: xr.Dataset,
+                       variable: str='v',
+                       weight_by_error: bool=True,
+                       weight_by_separation: bool=False):
+        """
+        fits per-pixel velocity trends over time for the whole cube in one pass, works chunk-wise
+        if the cube is backed by dask arrays (i.e. cube.chunk({'x': 256, 'y': 256}), keep time in one chunk).
+        params:
+            - cube: dataset returned by load_cube
+            - variable: velocity variable to fit, v, vx or vy
+            - weight_by_error: weights each layer by 1/v_err^2 when the cube has a v_err variable
+            - weight_by_separation: weights each layer by the days between the image pair
+        returns:
+            - an xarray dataset with:
+                trend: slope of the linear fit in velocity units per year
+                acceleration: second derivative of the quadratic fit in velocity units per year^2
+                r2: coefficient of determination of the linear fit
+                observations: number of valid layers per pixel
+        """
+        data = cube[variable]
+        time = cube.time.values
+        # Decimal years centered on the mean date keep the normal equations well conditioned
+        t = (time - time.min()) / np.timedelta64(1, 'D') / 365.25
+        t = t - t.mean()
+        weights = xr.ones_like(data)
+        error_var = f'{variable}_err' if f'{variable}_err' in cube else 'v_err'
+        if weight_by_error and error_var in cube:
+            weights = weights / cube[error_var] ** 2
+        if weight_by_separation and 'date_dt' in cube.coords:
+            weights = weights * cube.date_dt.broadcast_like(cube.time)
+        trend, acceleration, r2, count = xr.apply_ufunc(
+            VelocityProcessing._trend_kernel,
+            data, weights,
+            kwargs={'t': t},
+            input_core_dims=[['time'], ['time']],
+            output_core_dims=[[], [], [], []],
+            dask='parallelized',
+            output_dtypes=[float, float, float, int]
+        )
+        ds = xr.Dataset({
+            'trend': trend,
+            'acceleration': acceleration,
+            'r2': r2,
+            'observations': count
+        })
+        if cube.rio.crs is not None:
+            ds = ds.rio.write_crs(cube.rio.crs)
+        return ds
+
+    @staticmethod
+    def _overlap_matrix(cube: xr.Dataset, bins: pd.DatetimeIndex):
+        """
+        returns a (time, bin) matrix with the days each image pair overlaps each time bin.
+        Every pair only touches the few bins it spans, so most of the matrix is zero.
+        """
+        mid = cube.time.values
+        if 'date_dt' in cube.coords:
+            dt = cube.date_dt.broadcast_like(cube.time).values
+        else:
+            dt = np.ones(len(mid))
+        half = (dt * 86400 / 2).astype('timedelta64[s]')
+        start = ((mid - half) - bins[0].to_datetime64()) / np.timedelta64(1, 'D')
+        end = ((mid + half) - bins[0].to_datetime64()) / np.timedelta64(1, 'D')
+        edges = (bins.values - bins[0].to_datetime64()) / np.timedelta64(1, 'D')
+        overlap = np.minimum(end[:, None], edges[None, 1:]) - np.maximum(start[:, None], edges[None, :-1])
+        return xr.DataArray(np.clip(overlap, 0, None),
+                            dims=('time', 'bin'),
+                            coords={'time': cube.time, 'bin': bins[:-1]})
+
+    @staticmethod
+    def resample_cube(cube: xr.Dataset,
+                      frequency: str='annual',
+                      variables: list=None,
+                      drop_empty: bool=False):
+        """
+        averages the irregular image-pair layers onto a regular time grid, each pair is weighted by
+        the number of days it overlaps each bin rather than by where its mid-date falls.
+        Works chunk-wise if the cube is backed by dask arrays.
+        params:
+            - cube: dataset returned by load_cube
+            - frequency: 'monthly', 'quarterly' or 'annual'
+            - variables: variables to resample, defaults to v, vx and vy
+            - drop_empty: drops the bins no pair overlaps instead of keeping them as NaN layers
+        returns:
+            - an xarray dataset with one layer per bin, labeled by the bin start date
+        """
+        frequencies = {'monthly': 'MS', 'quarterly': 'QS', 'annual': 'YS'}
+        if frequency not in frequencies:
+            raise ValueError(f'Unknown frequency: {frequency}, use one of {list(frequencies)}')
+        if variables is None:
+            variables = [v for v in ['v', 'vx', 'vy'] if v in cube]
+        half = cube.date_dt.max().values / 2 if 'date_dt' in cube.coords else 1
+        first = pd.Timestamp(cube.time.values.min()) - pd.Timedelta(days=float(half))
+        last = pd.Timestamp(cube.time.values.max()) + pd.Timedelta(days=float(half))
+        offset = pd.tseries.frequencies.to_offset(frequencies[frequency])
+        bins = pd.date_range(offset.rollback(first.normalize()), last + offset, freq=offset)
+        overlap = VelocityProcessing._overlap_matrix(cube, bins)
+
+        resampled = {}
+        for var in variables:
+            data = cube[var]
+            valid = data.notnull()
+            # time is the only dimension they share, so it is the one summed over
+            weighted_sum = xr.dot(data.fillna(0), overlap)
+            weight = xr.dot(valid.astype(float), overlap)
+            resampled[var] = (weighted_sum / weight.where(weight > 0)).rename(bin='time')
+        ds = xr.Dataset(resampled).transpose('time', ...)
+        if cube.rio.crs is not None:
+            ds = ds.rio.write_crs(cube.rio.crs)
+        if drop_empty:
+            return ds.sel(time=(overlap.sum('time') > 0).values)
+        return ds
+
+    @staticmethod
+    def _write_cog(data: xr.DataArray, path: str):
+        data.rio.to_raster(path, driver='COG', compress='DEFLATE')
+        return path
+
+    @staticmethod
+    def export_cube(cube: xr.Dataset,
+                    path: str,
+                    format: str='netcdf',
+                    variables: list=None,
+                    chunks: dict=None,
+                    compression_level: int=4,
+                    threads: int=8):
+        """
+        writes a cube or an aggregate (i.e. the output of velocity_trend or resample_cube) to disk
+        compressed and chunked. Zarr chunks and COG slices are written by a pool of threads, NetCDF
+        writes go through the HDF5 lock so its chunks are compressed and written one at a time.
+        params:
+            - cube: xarray dataset with a CRS
+            - path: output file for netcdf, output store for zarr and output directory for cog
+            - format: 'netcdf', 'zarr' or 'cog', cog writes one Cloud-Optimized GeoTIFF per variable and time slice
+            - variables: variables to export, defaults to all of them
+            - chunks: chunk sizes per dimension, defaults to {'time': 32, 'y': 256, 'x': 256}
+            - compression_level: zlib compression level for netcdf
+            - threads: number of parallel writers
+        returns:
+            - list of the written paths
+        """
+        if variables is not None:
+            cube = cube[variables]
+        crs = cube.rio.crs
+        if crs is None:
+            logger.warning('The cube has no CRS, the exported files will not be georeferenced')
+        if chunks is None:
+            chunks = {'time': 32, 'y': 256, 'x': 256}
+        chunks = {dim: min(size, cube.sizes[dim]) for dim, size in chunks.items() if dim in cube.dims}
+        cube = cube.copy()
+        # Encodings inherited from the granules (chunk sizes, fill values) don't match the clipped cube
+        for var in cube.variables:
+            cube[var].encoding = {}
+        if crs is not None:
+            # Clearing the encodings drops the grid_mapping pointer to the CRS coordinate (Polar_Stereographic
+            # or UTM_Projection in load_cube output), listing it in coordinates makes readers decode it as one
+            cube = cube.rio.write_crs(crs)
+            for var in cube.data_vars:
+                cube[var].encoding['coordinates'] = ' '.join(
+                    str(coord) for coord in cube[var].coords if coord not in cube[var].dims)
+
+        if format == 'cog':
+            os.makedirs(path, exist_ok=True)
+            slices = []
+            for var in cube.data_vars:
+                if 'time' in cube[var].dims:
+                    for t in cube.time.values:
+                        date = pd.Timestamp(t).strftime('%Y%m%d')
+                        slices.append((cube[var].sel(time=t).drop_vars('time'), f'{path}/{var}_{date}.tif'))
+                else:
+                    slices.append((cube[var], f'{path}/{var}.tif'))
+            return Parallel(n_jobs=threads, prefer='threads')(
+                delayed(VelocityProcessing._write_cog)(data, file_path) for data, file_path in slices)
+
+        cube = cube.chunk(chunks)
+        if format == 'netcdf':
+            for var in cube.data_vars:
+                # Added to the variable encoding, an encoding argument would replace the grid_mapping set above
+                cube[var].encoding.update(
+                    zlib=True,
+                    complevel=compression_level,
+                    chunksizes=tuple(chunks.get(dim, cube.sizes[dim]) for dim in cube[var].dims)
+                )
+            writer = cube.to_netcdf(path, engine='netcdf4', compute=False)
+        elif format == 'zarr':
+            # zarr compresses every chunk by default
+            writer = cube.to_zarr(path, mode='w', compute=False)
+        else:
+            raise ValueError(f'Unknown format: {format}, use netcdf, zarr or cog')
+        writer.compute(scheduler='threads', num_workers=threads)
+        return [path]
+
+    @staticmethod
+    def _json_attr(value):
+        if isinstance(value, (np.ndarray, np.generic)):
+            return value.tolist()
+        return str(value)
+
+    @staticmethod
+    def save_shared_cube(cube: xr.Dataset, directory: str):
+        """
+        materializes a cube once as raw arrays that other kernels and worker processes can memory-map,
+        every variable goes to a .npy file and the coordinates and attributes to a small coords.nc sidecar.
+        Each save goes to a new version subdirectory and manifest.json is atomically switched to it, so
+        saving again never touches the files other processes have mapped.
+        params:
+            - cube: xarray dataset, dask-backed cubes are written one time slice at a time
+            - directory: output directory, usually next to the granules of the project
+        returns:
+            - the directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        version = uuid4().hex
+        os.makedirs(f'{directory}/{version}')
+        variables = {}
+        for var in cube.data_vars:
+            data = cube[var]
+            out = np.lib.format.open_memmap(f'{directory}/{version}/{var}.npy', mode='w+',
+                                            dtype=data.dtype, shape=data.shape)
+            if 'time' in data.dims and data.dims[0] == 'time':
+                for i in range(data.sizes['time']):
+                    out[i] = data.isel(time=i).values
+            else:
+                out[...] = data.values
+            out.flush()
+            del out
+            variables[var] = {'dims': list(data.dims), 'attrs': data.attrs}
+        coords = cube.drop_vars(list(cube.data_vars))
+        for var in coords.variables:
+            coords[var].encoding = {}
+        coords.to_netcdf(f'{directory}/{version}/coords.nc')
+
+        manifest = {'version': version, 'variables': variables}
+        crs = cube.rio.crs
+        if crs is not None:
+            # The grid mapping attributes don't survive the sidecar, the CRS is restored from the manifest
+            manifest.update(crs=crs.to_wkt(), grid_mapping=cube.rio.grid_mapping)
+
+        previous = None
+        if os.path.exists(f'{directory}/manifest.json'):
+            with open(f'{directory}/manifest.json') as infile:
+                previous = json.load(infile).get('version')
+        # Switched last and atomically, readers only attach to complete cubes
+        with open(f'{directory}/manifest.json.{version}', 'w') as outfile:
+            outfile.write(json.dumps(manifest, default=VelocityProcessing._json_attr))
+        os.replace(f'{directory}/manifest.json.{version}', f'{directory}/manifest.json')
+        # Keeps the previous version for readers that are still opening it, files that are
+        # already mapped stay readable after they are removed. Only version directories are
+        # removed, the cube usually shares its directory with the project granules
+        for entry in os.listdir(directory):
+            if entry not in (version, previous) and re.fullmatch('[0-9a-f]{32}', entry) \
+                    and os.path.isdir(f'{directory}/{entry}'):
+                shutil.rmtree(f'{directory}/{entry}', ignore_errors=True)
+        return directory
+
+    @staticmethod
+    def open_shared_cube(directory: str):
+        """
+        opens a cube written by save_shared_cube without copying it, the arrays are read-only memory maps
+        so every process attached to the same files shares the operating system page cache.
+        params:
+            - directory: directory written by save_shared_cube
+        returns:
+            - an xarray dataset backed by read-only memory maps
+        """
+        if not os.path.exists(f'{directory}/manifest.json'):
+            raise FileNotFoundError(f'No shared cube found in {directory}')
+        with open(f'{directory}/manifest.json') as infile:
+            manifest = json.load(infile)
+        version = f"{directory}/{manifest['version']}"
+        with xr.open_dataset(f'{version}/coords.nc') as coords:
+            coords = coords.load()
+        data_vars = {}
+        for var, meta in manifest['variables'].items():
+            data = np.load(f'{version}/{var}.npy', mmap_mode='r')
+            # JSON has no arrays, array attributes come back as lists
+            attrs = {k: np.asarray(v) if isinstance(v, list) else v for k, v in meta['attrs'].items()}
+            data_vars[var] = xr.Variable(meta['dims'], data, attrs=attrs)
+        cube = xr.Dataset(data_vars, coords=coords.coords, attrs=coords.attrs)
+        if 'crs' in manifest:
+            cube = cube.rio.write_crs(manifest['crs'], grid_mapping_name=manifest['grid_mapping'])
+        return cube
+
+    @staticmethod
+    def _mad_outliers(v: np.ndarray, threshold: float, min_observations: int):
+        """
+        flags values further than threshold scaled MADs from the temporal median of their pixel,
+        time is the last axis.
+        """
+        with warnings.catch_warnings():
+            # All-NaN pixels are expected outside the glacier
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            median = np.nanmedian(v, axis=-1, keepdims=True)
+            mad = 1.4826 * np.nanmedian(np.abs(v - median), axis=-1, keepdims=True)
+        observations = np.isfinite(v).sum(axis=-1, keepdims=True)
+        return (np.abs(v - median) > threshold * mad) & (observations >= min_observations)
+
+    @staticmethod
+    def reject_outliers(cube: xr.Dataset,
+                        mad_threshold: float=3.0,
+                        min_observations: int=5,
+                        max_relative_error: float=1.0,
+                        min_error: float=10.0,
+                        consistency_tolerance: float=0.1,
+                        min_inconsistency: float=2.0,
+                        variables: list=None):
+        """
+        masks outliers in a velocity cube, a value rejected by any rule is set to NaN in all the velocity variables.
+        Numpy-backed cubes are cleaned in place, dask-backed cubes are cleaned lazily chunk by chunk
+        (i.e. cube.chunk({'x': 256, 'y': 256}), keep time in one chunk) into a new dataset and the input is
+        left untouched, neither makes a second copy of the cube. The report and the dask-backed cleaned cube
+        share the same graph, compute them together with dask.compute(cleaned, report) to run it once.
+        params:
+            - cube: dataset returned by load_cube
+            - mad_threshold: rejects v further than this many scaled MADs from the temporal median of its pixel, None disables it
+            - min_observations: minimum number of valid layers for a pixel to apply the MAD rule
+            - max_relative_error: rejects layers where v_err > max(max_relative_error * v, min_error),
+              only if the cube has v_err, None disables it
+            - min_error: error in m/yr always accepted, so slow ice isn't rejected for errors that are large only relative to v
+            - consistency_tolerance: rejects layers where
+              |sqrt(vx^2 + vy^2) - v| > max(consistency_tolerance * v, min_inconsistency), None disables it
+            - min_inconsistency: difference in m/yr always accepted, v, vx and vy are rounded to whole m/yr in the granules
+            - variables: variables to mask, defaults to v, vx and vy
+        returns:
+            - the cleaned cube
+            - an xarray dataset with the number of pixels rejected by each rule and in total,
+              rules can overlap, call .compute() on it for dask-backed cubes
+        """
+        if variables is None:
+            variables = [v for v in ['v', 'vx', 'vy'] if v in cube]
+        # Shallow copy, lazily masked variables are assigned to it and not to the caller's dataset
+        cube = cube.copy(deep=False)
+        v = cube.v
+        rules = {'negative_speed': v < 0}
+        if mad_threshold is not None:
+            rules['temporal_mad'] = xr.apply_ufunc(
+                VelocityProcessing._mad_outliers,
+                v,
+                kwargs={'threshold': mad_threshold, 'min_observations': min_observations},
+                input_core_dims=[['time']],
+                output_core_dims=[['time']],
+                dask='parallelized',
+                output_dtypes=[bool]
+            ).transpose(*v.dims)
+        if max_relative_error is not None and 'v_err' in cube:
+            rules['relative_error'] = cube.v_err > np.maximum(max_relative_error * v, min_error)
+        if consistency_tolerance is not None and 'vx' in cube and 'vy' in cube:
+            tolerance = np.maximum(consistency_tolerance * v, min_inconsistency)
+            rules['consistency'] = abs(np.hypot(cube.vx, cube.vy) - v) > tolerance
+
+        valid = v.notnull()
+        rejected = xr.zeros_like(valid)
+        report = {}
+        for rule, mask in rules.items():
+            report[rule] = (mask & valid).sum()
+            rejected = rejected | mask
+        rejected = rejected & valid
+        report['total'] = rejected.sum()
+
+        for var in variables:
+            data = cube[var]
+            if data.chunks is None and data.values.flags.writeable:
+                data.values[rejected.transpose(*data.dims).values] = np.nan
+            else:
+                cube[var] = data.where(~rejected)
+        return cube, xr.Dataset(report)
+
     @staticmethod
     def plot_cube(cube:str):
         return None
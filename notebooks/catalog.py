@@ -0,0 +1,218 @@
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+import geopandas
+import numpy as np
+import pandas as pd
+import xarray as xr
+from granules import parse_granule_names
+from pqdm.threads import pqdm
+from shapely import wkt
+from shapely.geometry import Point, Polygon, box
+from shapely.ops import unary_union
+
+logger = logging.getLogger('CATALOG')
+
+
+class GranuleCatalog():
+    """
+    Local catalog of ITS_LIVE granules, answers the same queries as map.Search without the API.
+    The catalog lives in a SQLite file so it can be copied to air-gapped nodes, queries use an
+    R-tree over the footprints and binary search over the sorted mid-dates.
+    """
+    def __init__(self, path: str='data/catalog.sqlite'):
+        """
+        path: SQLite file, created if it does not exist
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS granules (
+                granule TEXT PRIMARY KEY,
+                url TEXT,
+                path TEXT,
+                sensor TEXT,
+                start TEXT,
+                end TEXT,
+                mid_date TEXT,
+                separation INTEGER,
+                valid_pixels INTEGER,
+                footprint TEXT
+            )""")
+        self._connection.commit()
+        self._load()
+
+    def _load(self):
+        granules = pd.read_sql('SELECT * FROM granules', self._connection,
+                               parse_dates=['start', 'end', 'mid_date'])
+        granules = granules.sort_values('mid_date', kind='mergesort').reset_index(drop=True)
+        self.granules = geopandas.GeoDataFrame(granules.drop(columns='footprint'),
+                                               geometry=[wkt.loads(f) for f in granules['footprint']],
+                                               crs='epsg:4326')
+        self._mid_dates = self.granules['mid_date'].values
+
+    def __len__(self):
+        return len(self.granules)
+
+    def _upsert(self, sources: list, footprints: list, column: str):
+        """
+        adds or updates granules keyed by file name, so the same granule harvested from the API and
+        indexed from disk is a single row with both its url and its local path.
+        """
+        new = parse_granule_names(sources).rename(columns={'url': column})
+        new['granule'] = new[column].str.split('/').str[-1]
+        new['footprint'] = list(footprints)
+        # A granule returned by several harvest tiles covers all of them
+        new = new.groupby('granule', sort=False).agg({
+            column: 'first', 'sensor': 'first', 'start': 'first', 'end': 'first', 'mid_date': 'first',
+            'separation': 'first', 'valid_pixels': 'first', 'footprint': unary_union
+        }).reset_index()
+        existing = self.granules.set_index('granule')
+        known = new['granule'].isin(existing.index)
+        if column == 'url':
+            # Footprints from files are exact, tile footprints only grow footprints that came from tiles
+            footprints = []
+            for granule, footprint in zip(new.loc[known, 'granule'], new.loc[known, 'footprint']):
+                if pd.isnull(existing.at[granule, 'path']):
+                    footprint = footprint.union(existing.at[granule, 'geometry'])
+                else:
+                    footprint = existing.at[granule, 'geometry']
+                footprints.append(footprint)
+            new.loc[known, 'footprint'] = footprints
+        rows = [(r.granule, getattr(r, column), r.sensor, r.start.strftime('%Y-%m-%d'), r.end.strftime('%Y-%m-%d'),
+                 r.mid_date.strftime('%Y-%m-%d'), int(r.separation), int(r.valid_pixels), r.footprint.wkt)
+                for r in new.itertuples()]
+        self._connection.executemany(f"""
+            INSERT INTO granules (granule, {column}, sensor, start, end, mid_date, separation, valid_pixels, footprint)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(granule) DO UPDATE SET {column} = excluded.{column}, footprint = excluded.footprint
+            """, rows)
+        self._connection.commit()
+        self._load()
+        return len(rows)
+
+    def add(self, urls: list, footprints: list):
+        """
+        adds or updates granules found through the API, the footprint of a granule already
+        in the catalog is merged with the new one.
+        params:
+            - urls: array of ITS_LIVE urls
+            - footprints: array of shapely geometries in EPSG:4326, one per url
+        """
+        return self._upsert(urls, footprints, 'url')
+
+    @staticmethod
+    def _grid_footprint(ds: xr.Dataset, projection: int, points: int=64):
+        """
+        returns the extent of a granule grid in EPSG:4326, the edges are densified before reprojecting
+        because straight lines in polar stereographic or UTM are curves in longitude and latitude.
+        """
+        x = np.linspace(float(ds.x.min()), float(ds.x.max()), points)
+        y = np.linspace(float(ds.y.min()), float(ds.y.max()), points)
+        ring = np.concatenate([
+            np.column_stack([x, np.full(points, y[0])]),
+            np.column_stack([np.full(points, x[-1]), y]),
+            np.column_stack([x[::-1], np.full(points, y[-1])]),
+            np.column_stack([np.full(points, x[0]), y[::-1]])
+        ])
+        extent = Polygon(ring)
+        footprint = geopandas.GeoSeries([extent], crs=projection).to_crs(epsg=4326).iloc[0]
+        # A grid around a pole wraps all longitudes, its footprint is the polar cap
+        poles = geopandas.GeoSeries([Point(0, -90), Point(0, 90)], crs='epsg:4326').to_crs(epsg=projection)
+        lats = np.array(footprint.exterior.coords)[:, 1]
+        if extent.contains(poles.iloc[0]):
+            return box(-180, -90, 180, lats.max())
+        if extent.contains(poles.iloc[1]):
+            return box(-180, lats.min(), 180, 90)
+        return footprint
+
+    def add_files(self, paths: list):
+        """
+        adds downloaded granules using the extent of their grids as footprints, the local path is
+        stored next to the url so search can return either.
+        params:
+            - paths: array of local NetCDF paths
+        """
+        footprints = []
+        for path in paths:
+            with xr.open_dataset(path) as ds:
+                proj_var = 'UTM_Projection' if 'UTM_Projection' in ds else 'Polar_Stereographic'
+                projection = int(ds[proj_var].spatial_epsg)
+                footprints.append(self._grid_footprint(ds, projection))
+        return self._upsert(paths, footprints, 'path')
+
+    def harvest(self, params: dict, tile_size: float=1.0, threads: int=8):
+        """
+        fills the catalog from the ITS_LIVE API, the area is queried in tiles and each granule gets
+        the union of the tiles it was returned for as footprint, so footprints are accurate to tile_size.
+        params:
+            - params: same dictionary as map.Search, with a bbox
+            - tile_size: tile size in degrees
+            - threads: number of parallel queries
+        """
+        # Imported here so querying the catalog doesn't need the widget stack
+        from SearchWidget import map
+        min_x, min_y, max_x, max_y = [float(c) for c in params['bbox'].split(',')]
+        tiles = [box(x, y, min(x + tile_size, max_x), min(y + tile_size, max_y))
+                 for x in np.arange(min_x, max_x, tile_size)
+                 for y in np.arange(min_y, max_y, tile_size)]
+        arguments = [dict(params, bbox=','.join(str(c) for c in tile.bounds)) for tile in tiles]
+        results = pqdm(arguments, map.Search, n_jobs=threads)
+        urls = []
+        footprints = []
+        for tile, tile_urls in zip(tiles, results):
+            if not isinstance(tile_urls, list):
+                logger.warning(f'Tile {tile.bounds} failed: {tile_urls}')
+                continue
+            urls.extend(tile_urls)
+            footprints.extend([tile] * len(tile_urls))
+        return self.add(urls, footprints)
+
+    def refresh(self, params: dict, tile_size: float=1.0, threads: int=8):
+        """
+        harvests only the granules that may have been published since the last harvest, pairs whose
+        second image was acquired after the newest one in the catalog minus the max separation.
+        """
+        if len(self) == 0:
+            return self.harvest(params, tile_size, threads)
+        max_separation = params.get('max_separation', 365)
+        if max_separation == 'any':
+            max_separation = 365
+        start = self.granules['end'].max().to_pydatetime() - timedelta(days=int(max_separation))
+        params = dict(params, start=start.strftime('%Y-%m-%d'), end=datetime.now().strftime('%Y-%m-%d'))
+        return self.harvest(params, tile_size, threads)
+
+    def search(self, params: dict, local: bool=False):
+        """
+        returns the granule URLs matching the same parameters as map.Search.
+        params:
+            - params: dictionary with bbox or polygon as comma separated lon,lat values, start, end
+              and optionally percent_valid_pixels, min_separation, max_separation and mission
+            - local: returns the local paths of the matching granules added with add_files instead
+        """
+        if 'polygon' in params:
+            coords = [float(c) for c in str(params['polygon']).split(',')]
+            geometry = Polygon(zip(coords[0::2], coords[1::2]))
+        else:
+            geometry = box(*[float(c) for c in str(params['bbox']).split(',')])
+        # Granules are sorted by mid-date, the date range is a contiguous slice
+        lo = np.searchsorted(self._mid_dates, np.datetime64(params['start']), side='left')
+        hi = np.searchsorted(self._mid_dates, np.datetime64(params['end']), side='right')
+        candidates = np.sort(self.granules.sindex.query(geometry, predicate='intersects'))
+        candidates = candidates[(candidates >= lo) & (candidates < hi)]
+        granules = self.granules.iloc[candidates]
+
+        keep = np.ones(len(granules), dtype=bool)
+        if params.get('percent_valid_pixels') is not None:
+            keep &= granules['valid_pixels'].values >= int(params['percent_valid_pixels'])
+        min_separation = params.get('min_separation', params.get('min_interval'))
+        if min_separation not in (None, 'any', ''):
+            keep &= granules['separation'].values >= int(min_separation)
+        max_separation = params.get('max_separation', params.get('max_interval'))
+        if max_separation not in (None, 'any', ''):
+            keep &= granules['separation'].values <= int(max_separation)
+        if params.get('mission'):
+            keep &= (granules['sensor'] == params['mission']).values
+        results = granules['path' if local else 'url'][keep]
+        return results[results.notnull()].tolist()
@@ -0,0 +1,79 @@
+import pandas as pd
+
+
+def parse_granule_names(urls: list):
+    """
+    parses the fields encoded in ITS_LIVE granule names into a dataframe, one row per url or path.
+    i.e. LE07_L1TP_008012_20030417_20170125_01_T1_X_LE07_L1TP_008012_20030401_20170126_01_T1_G0240V01_P095.nc
+    params:
+        - urls: array of ITS_LIVE urls or local paths
+    returns:
+        - a pandas dataframe with the columns url, sensor, start, end, mid_date, separation and valid_pixels
+    """
+    if len(urls) == 0:
+        return pd.DataFrame({'url': pd.Series([], dtype=object),
+                             'sensor': pd.Series([], dtype=object),
+                             'start': pd.Series([], dtype='datetime64[ns]'),
+                             'end': pd.Series([], dtype='datetime64[ns]'),
+                             'mid_date': pd.Series([], dtype='datetime64[ns]'),
+                             'separation': pd.Series([], dtype=int),
+                             'valid_pixels': pd.Series([], dtype=int)})
+    names = pd.Series(urls, dtype=object).str.split('/').str[-1].str.replace('.nc', '', regex=False)
+    components = names.str.split('_', expand=True)
+    start = pd.to_datetime(components[11], format='%Y%m%d')
+    end = pd.to_datetime(components[3], format='%Y%m%d')
+    return pd.DataFrame({
+        'url': urls,
+        'sensor': components[0],
+        'start': start,
+        'end': end,
+        'mid_date': (start + (end - start) / 2).dt.floor('D'),
+        'separation': (end - start).dt.days,
+        'valid_pixels': components[16].str[1:].astype(int)
+    })
+
+
+def rank_granules(granules: pd.DataFrame,
+                  rank_by: list=None,
+                  preferred_separation: tuple=None,
+                  preferred_sensors: list=None):
+    """
+    sorts parsed granules from the most to the least useful, ties keep their original order.
+    params:
+        - granules: dataframe returned by parse_granule_names
+        - rank_by: criteria in priority order, any of:
+            'sensor': files from preferred_sensors first, in the given order
+            'separation': files with a separation inside preferred_separation first, then the closest to it
+            'valid_pixels': files with the highest valid pixel percentage first
+        - preferred_separation: (min, max) days between image pairs
+        - preferred_sensors: array of sensors, i.e. ['LC08', 'LE07']
+    returns:
+        - the sorted dataframe, the index still points to the original rows
+    """
+    if isinstance(rank_by, str):
+        rank_by = [rank_by]
+    sort_keys = []
+    for criteria in rank_by or []:
+        if criteria not in ('sensor', 'separation', 'valid_pixels'):
+            raise ValueError(f'Unknown rank criteria: {criteria}, use sensor, separation or valid_pixels')
+        if criteria == 'sensor' and not preferred_sensors:
+            raise ValueError('rank_by sensor needs preferred_sensors')
+        if criteria == 'separation' and not preferred_separation:
+            raise ValueError('rank_by separation needs preferred_separation')
+        if criteria == 'sensor':
+            ranks = {sensor: i for i, sensor in enumerate(preferred_sensors)}
+            granules = granules.assign(sensor_rank=granules['sensor'].map(ranks).fillna(len(ranks)))
+            sort_keys.append(('sensor_rank', True))
+        elif criteria == 'separation':
+            low, high = preferred_separation
+            distance = (low - granules['separation']).clip(lower=0) + (granules['separation'] - high).clip(lower=0)
+            granules = granules.assign(separation_rank=distance)
+            sort_keys.append(('separation_rank', True))
+        elif criteria == 'valid_pixels':
+            sort_keys.append(('valid_pixels', False))
+    if len(sort_keys) == 0:
+        return granules
+    # mergesort is stable, ties keep the original order
+    return granules.sort_values([k for k, _ in sort_keys],
+                                ascending=[a for _, a in sort_keys],
+                                kind='mergesort')
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import numpy as np
+import xarray as xr
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'notebooks'))
+
+from catalog import GranuleCatalog  # noqa: E402
+
+NAME = 'LE07_L1GT_001113_20121118_20161127_01_T2_X_LE07_L1GT_232113_20121104_20161127_01_T2_G0240V01_P059.nc'
+
+
+def write_granule(path, x, y):
+    ds = xr.Dataset({'v': (('y', 'x'), np.zeros((len(y), len(x)), dtype='float32')),
+                     'Polar_Stereographic': ((), 0, {'spatial_epsg': 3031.0})},
+                    coords={'x': x, 'y': y})
+    ds.to_netcdf(path)
+
+
+def test_same_granule_from_api_and_disk_is_one_row(tmp_path):
+    path = str(tmp_path / NAME)
+    write_granule(path, np.linspace(-1716367.5, -1564000, 50), np.linspace(-209392.5, -351000, 50))
+    catalog = GranuleCatalog(str(tmp_path / 'catalog.sqlite'))
+    catalog.add_files([path])
+    footprint = catalog.granules.geometry.iloc[0]
+    catalog.add([f'https://its-live-data/velocity_image_pair/{NAME}'], [box(-110, -80, -90, -70)])
+    assert len(catalog) == 1
+    # The exact footprint from the file is kept
+    assert catalog.granules.geometry.iloc[0].equals(footprint)
+
+    lon, lat = footprint.centroid.coords[0]
+    params = {'bbox': f'{lon - 0.1},{lat - 0.1},{lon + 0.1},{lat + 0.1}', 'start': '2012-01-01', 'end': '2013-01-01'}
+    assert catalog.search(params) == [f'https://its-live-data/velocity_image_pair/{NAME}']
+    assert catalog.search(params, local=True) == [path]
+
+
+def test_grid_around_the_pole_covers_the_cap():
+    ds = xr.Dataset(coords={'x': np.linspace(-1e5, 1e5, 10), 'y': np.linspace(-1e5, 1e5, 10)})
+    min_x, min_y, max_x, max_y = GranuleCatalog._grid_footprint(ds, 3031).bounds
+    assert (min_x, min_y, max_x) == (-180, -90, 180)
+    assert max_y < -88
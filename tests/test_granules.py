@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'notebooks'))
+
+from granules import parse_granule_names, rank_granules  # noqa: E402
+
+
+def url(first, second, valid_pixels, sensor='LE07'):
+    return (f'https://its-live-data/{sensor}_L1TP_008012_{second}_20170125_01_T1_X_'
+            f'{sensor}_L1TP_008012_{first}_20170126_01_T1_G0240V01_P{valid_pixels:03d}.nc')
+
+
+URLS = [url('20030401', '20030417', 10),
+        url('20030501', '20030517', 95),
+        url('20030601', '20030917', 50, 'LC08')]
+
+
+def test_parse_granule_names():
+    granules = parse_granule_names(URLS)
+    assert list(granules['valid_pixels']) == [10, 95, 50]
+    assert list(granules['separation']) == [16, 16, 108]
+    assert list(granules['sensor']) == ['LE07', 'LE07', 'LC08']
+    assert str(granules['mid_date'][0].date()) == '2003-04-09'
+
+
+def test_rank_granules():
+    granules = parse_granule_names(URLS)
+    assert list(rank_granules(granules, 'valid_pixels').index) == [1, 2, 0]
+    assert list(rank_granules(granules, ['sensor', 'valid_pixels'], preferred_sensors=['LC08']).index) == [2, 1, 0]
+    assert list(rank_granules(granules, 'separation', preferred_separation=(60, 120)).index) == [2, 0, 1]
+    assert list(rank_granules(granules).index) == [0, 1, 2]
+
+
+def test_rank_granules_rejects_bad_criteria():
+    granules = parse_granule_names(URLS)
+    with pytest.raises(ValueError):
+        rank_granules(granules, 'valid_pixel')
+    with pytest.raises(ValueError):
+        rank_granules(granules, 'sensor')
+    with pytest.raises(ValueError):
+        rank_granules(granules, 'separation')
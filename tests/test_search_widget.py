@@ -0,0 +1,52 @@
+import importlib.util
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'notebooks'))
+
+from test_granules import url  # noqa: E402
+
+
+URLS = [url('20030401', '20030417', 10),
+        url('20030501', '20030517', 95),
+        url('20030601', '20030917', 50, 'LC08'),
+        url('20030505', '20030521', 99),
+        url('20040101', '20040117', 30),
+        url('20040201', '20040601', 80, 'LC08')]
+
+
+@pytest.fixture
+def search(monkeypatch):
+    # filter_urls doesn't touch the widget stack, missing widget packages are replaced by mocks
+    for name in ['ipywidgets', 'requests', 'bqplot', 'ipyleaflet', 'IPython.display', 'pqdm.threads', 'sidecar']:
+        if importlib.util.find_spec(name.split('.')[0]) is None:
+            for module in [name.split('.')[0], name]:
+                monkeypatch.setitem(sys.modules, module, mock.MagicMock())
+    monkeypatch.delitem(sys.modules, 'SearchWidget', raising=False)
+    monkeypatch.delitem(sys.modules, 'projections', raising=False)
+    from SearchWidget import map
+    yield map.__new__(map)
+    sys.modules.pop('SearchWidget', None)
+    sys.modules.pop('projections', None)
+
+
+def test_filter_urls_keeps_api_order(search):
+    assert search.filter_urls(URLS, by_year=False) == URLS
+    assert search.filter_urls(URLS, max_files_per_year=2) == {'2003': URLS[:2], '2004': URLS[4:]}
+    assert search.filter_urls(URLS, max_files_per_month=1, by_year=False) == URLS[:3] + URLS[4:]
+    assert search.filtered_urls_by_year == {'2003': URLS[:3], '2004': URLS[4:]}
+
+
+def test_filter_urls_rank_by(search):
+    assert search.filter_urls(URLS, max_files_per_year=2, rank_by='valid_pixels', by_year=False) == \
+        [URLS[1], URLS[3], URLS[4], URLS[5]]
+    # Kept files are returned in API order whatever the ranking
+    assert search.filter_urls(URLS, max_files_per_year=1, rank_by=['sensor', 'valid_pixels'],
+                              preferred_sensors=['LC08']) == {'2003': [URLS[2]], '2004': [URLS[5]]}
+    assert search.filter_urls(URLS, max_files_per_month=1, max_files_per_year=2, rank_by='valid_pixels',
+                              by_year=False) == [URLS[2], URLS[3], URLS[4], URLS[5]]
+    assert search.filter_urls(URLS, rank_by=['separation', 'valid_pixels'], preferred_separation=(100, 120),
+                              max_files_per_year=1, months=['May', 'July', 'Jan'], by_year=False) == [URLS[2], URLS[4]]
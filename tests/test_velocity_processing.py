@@ -0,0 +1,248 @@
+import os
+import subprocess
+import sys
+
+import dask
+import geopandas
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import xarray as xr
+from shapely.geometry import Point
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'notebooks'))
+
+from test_granules import url  # noqa: E402
+from VelocityProcessing import VelocityProcessing  # noqa: E402
+
+
+def granule(x0, y0, nx=40, ny=30, res=240.0):
+    x = x0 + res / 2 + res * np.arange(nx)
+    y = y0 - res / 2 - res * np.arange(ny)
+    v = np.add.outer(y, x).astype('float32')
+    return xr.Dataset({'v': (('y', 'x'), v)}, coords={'x': x, 'y': y})
+
+
+def test_decimate_aligns_granules_with_different_extents():
+    # Same native grid, the second granule starts one column and one row later
+    granules = [granule(-1716480.0, -209280.0), granule(-1716240.0, -209520.0)]
+    native = xr.concat(granules, dim='time', join='outer')
+    for resampling in ['stride', 'mean']:
+        decimated = [VelocityProcessing._decimate(g, 1200, resampling) for g in granules]
+        cube = xr.concat(decimated, dim='time', join='outer')
+        assert cube.sizes['x'] == max(d.sizes['x'] for d in decimated)
+        assert cube.sizes['y'] == max(d.sizes['y'] for d in decimated)
+        assert cube.sizes['x'] <= native.sizes['x'] // 5 + 1
+        np.testing.assert_array_equal(np.diff(cube.x), 1200)
+        # Pixels both granules cover are present in both layers
+        overlap = cube.v.notnull().all('time')
+        assert int(overlap.sum()) > 0.7 * overlap.size
+
+
+def test_dedupe_paths():
+    # The first three pairs are centered on 2012-11-11
+    landsat8 = url('20121101', '20121121', 40, 'LC08')
+    landsat8_long = url('20121027', '20121126', 90, 'LC08')
+    landsat7 = url('20121104', '20121118', 59, 'LE07')
+    other = url('20121207', '20121215', 30, 'LE07')
+    paths = sorted([landsat7, landsat8, other, landsat8_long])
+    assert paths[0] == landsat8
+    assert VelocityProcessing._dedupe_paths(paths) == [landsat8, other]
+    assert VelocityProcessing._dedupe_paths(paths, 'valid_pixels') == [landsat8_long, other]
+    assert VelocityProcessing._dedupe_paths(paths, 'separation') == [landsat7, other]
+    assert VelocityProcessing._dedupe_paths(paths, 'sensor', ['LE07']) == [landsat7, other]
+    assert VelocityProcessing._dedupe_paths(paths, 'sensor', ['LC08']) == [landsat8_long, other]
+    with pytest.raises(ValueError):
+        VelocityProcessing._dedupe_paths(paths, 'newest')
+    # Names that don't follow the ITS_LIVE convention are left for the check on open
+    assert VelocityProcessing._dedupe_paths(['data/b.nc', 'data/a.nc'], 'valid_pixels') == ['data/b.nc', 'data/a.nc']
+
+
+def test_velocity_trend_matches_polyfit():
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2015-01-01', periods=8, freq='23D')
+    t = (time.values - time.values.min()) / np.timedelta64(1, 'D') / 365.25
+    t = t - t.mean()
+    v = 500 + 40 * t[:, None, None] + 25 * t[:, None, None] ** 2 + rng.normal(0, 5, (8, 4, 5))
+    v_err = rng.uniform(300, 6000, v.shape)
+    v[2, 0, 0] = np.nan
+    cube = xr.Dataset({'v': (('time', 'y', 'x'), v), 'v_err': (('time', 'y', 'x'), v_err)},
+                      coords={'time': time})
+    result = VelocityProcessing.velocity_trend(cube)
+    assert int(result.observations[0, 0]) == 7
+    for j in range(4):
+        for i in range(5):
+            valid = np.isfinite(v[:, j, i])
+            # np.polyfit weights are 1 / sigma
+            linear = np.polyfit(t[valid], v[valid, j, i], 1, w=1 / v_err[valid, j, i])
+            quadratic = np.polyfit(t[valid], v[valid, j, i], 2, w=1 / v_err[valid, j, i])
+            np.testing.assert_allclose(float(result.trend[j, i]), linear[0], rtol=1e-6)
+            np.testing.assert_allclose(float(result.acceleration[j, i]), 2 * quadratic[0], rtol=1e-6)
+
+
+def test_velocity_trend_keeps_the_crs():
+    # load_cube names the CRS coordinate after the granule's grid mapping variable
+    cube = granule(-1716480.0, -209280.0).expand_dims(time=pd.date_range('2015-01-01', periods=4, freq='30D'))
+    cube = cube.rio.write_crs(3031, grid_mapping_name='Polar_Stereographic')
+    assert VelocityProcessing.velocity_trend(cube).rio.crs == cube.rio.crs
+
+
+def test_velocity_trend_is_scale_invariant_in_errors():
+    # 8 exact points on a quadratic over half a year
+    time = pd.date_range('2015-01-01', periods=8, freq='26D')
+    t = (time.values - time.values.min()) / np.timedelta64(1, 'D') / 365.25
+    t = t - t.mean()
+    v = (100 + 10 * t + 3 * t ** 2)[:, None, None] * np.ones((8, 2, 2))
+    cube = xr.Dataset({'v': (('time', 'y', 'x'), v), 'v_err': (('time', 'y', 'x'), np.full(v.shape, 50.0))},
+                      coords={'time': time})
+    result = VelocityProcessing.velocity_trend(cube)
+    np.testing.assert_allclose(result.acceleration, 6, rtol=1e-6)
+
+
+def test_resample_cube_weights_pairs_by_overlap():
+    time = pd.to_datetime(['2010-12-20', '2011-06-01', '2011-12-25', '2014-06-01'])
+    v = np.ones((4, 2, 2))
+    v[1], v[2], v[3] = 3, 5, 7
+    cube = xr.Dataset({'v': (('time', 'y', 'x'), v)},
+                      coords={'time': time, 'date_dt': ('time', [20.0, 10.0, 40.0, 10.0])})
+    result = VelocityProcessing.resample_cube(cube, 'annual')
+    # The last pair spans Dec 5 2011 - Jan 14 2012, 27 days in 2011
+    np.testing.assert_allclose(result.v.sel(time='2011-01-01')[0, 0], (3 * 10 + 5 * 27) / 37)
+    # Bins no pair overlaps stay on the regular grid as NaN layers
+    assert list(result.time.dt.year.values) == [2010, 2011, 2012, 2013, 2014]
+    assert bool(result.v.sel(time='2013-01-01').isnull().all())
+    assert int(VelocityProcessing.resample_cube(cube, 'monthly', drop_empty=True).sizes['time']) < \
+        int(VelocityProcessing.resample_cube(cube, 'monthly').sizes['time'])
+
+
+def test_clip_matches_rio_clip():
+    ds = granule(-1716480.0, -209280.0)
+    ds['interp_mask'] = (ds.v > ds.v.median()).astype('uint8')
+    ds = ds.rio.write_crs(3031)
+    inner = geopandas.GeoSeries([Point(-1711000, -212500).buffer(3000)], crs=3031).to_crs(epsg=4326)
+    geometry = VelocityProcessing.polygon_to_geojson(list(inner.iloc[0].exterior.coords))
+    expected = ds.rio.clip([geometry], crs='epsg:4326')
+    clipped = VelocityProcessing._clip(ds, geometry, 3031, {}, {})
+    for var in expected.data_vars:
+        assert clipped[var].dtype == expected[var].dtype
+        xr.testing.assert_equal(clipped[var].drop_vars('spatial_ref'), expected[var].drop_vars('spatial_ref'))
+    assert clipped.rio.crs == expected.rio.crs
+
+
+def shared_cube(nt, value):
+    time = pd.date_range('2015-01-01', periods=nt, freq='30D')
+    v = np.full((nt, 30, 40), value, dtype='float32')
+    cube = granule(-1716480.0, -209280.0).expand_dims(time=time).copy()
+    cube['v'] = (('time', 'y', 'x'), v, {'flag_values': np.array([0, 1]), 'scale': np.float32(2.0), 'units': 'm/y'})
+    return cube
+
+
+def test_shared_cube_round_trip(tmp_path):
+    cube = shared_cube(3, 1.0)
+    VelocityProcessing.save_shared_cube(cube, str(tmp_path))
+    shared = VelocityProcessing.open_shared_cube(str(tmp_path))
+    xr.testing.assert_identical(shared, cube)
+    np.testing.assert_array_equal(shared.v.attrs['flag_values'], [0, 1])
+    assert not np.asarray(shared.v.data).flags.writeable
+
+
+def test_shared_cube_keeps_the_crs(tmp_path):
+    cube = shared_cube(3, 1.0).rio.write_crs(3031, grid_mapping_name='Polar_Stereographic')
+    VelocityProcessing.save_shared_cube(cube, str(tmp_path))
+    shared = VelocityProcessing.open_shared_cube(str(tmp_path))
+    assert shared.rio.crs == cube.rio.crs
+    assert shared.rio.grid_mapping == 'Polar_Stereographic'
+    xr.testing.assert_identical(shared, cube)
+
+
+def test_shared_cube_only_removes_its_versions(tmp_path):
+    # Shared cubes usually live next to the granules and other outputs of the project
+    unrelated = tmp_path / 'exported'
+    unrelated.mkdir()
+    (unrelated / 'coords.nc').touch()
+    for value in range(3):
+        VelocityProcessing.save_shared_cube(shared_cube(2, value), str(tmp_path))
+    versions = [entry.name for entry in tmp_path.iterdir() if entry.is_dir() and entry != unrelated]
+    assert len(versions) == 2
+    assert (unrelated / 'coords.nc').exists()
+    assert float(VelocityProcessing.open_shared_cube(str(tmp_path)).v.max()) == 2
+
+
+def test_shared_cube_survives_being_saved_again(tmp_path):
+    # A reader keeps its mapping while another process saves a smaller cube to the same directory,
+    # it runs in a subprocess because touching a truncated mapping kills the process with SIGBUS
+    notebooks = os.path.join(os.path.dirname(__file__), '..', 'notebooks')
+    script = f"""
+import sys
+sys.path.insert(0, {notebooks!r})
+sys.path.insert(0, {os.path.dirname(__file__)!r})
+from test_velocity_processing import shared_cube
+from VelocityProcessing import VelocityProcessing
+VelocityProcessing.save_shared_cube(shared_cube(20, 1.0), {str(tmp_path)!r})
+reader = VelocityProcessing.open_shared_cube({str(tmp_path)!r})
+VelocityProcessing.save_shared_cube(shared_cube(2, 2.0), {str(tmp_path)!r})
+assert float(reader.v.sum()) == 20 * 30 * 40
+assert float(VelocityProcessing.open_shared_cube({str(tmp_path)!r}).v.sum()) == 2 * 2 * 30 * 40
+"""
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_reject_outliers():
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2015-01-01', periods=12, freq='30D')
+    v = 100 + rng.normal(0, 1, (12, 6, 8))
+    v[3, 2, 2] = 5000
+    v[5, 1, 1] = -1
+    cube = xr.Dataset({'v': (('time', 'y', 'x'), v), 'vx': (('time', 'y', 'x'), v.copy()),
+                       'vy': (('time', 'y', 'x'), np.zeros_like(v))}, coords={'time': time})
+    lazy = cube.chunk({'x': 4, 'y': 3})
+    cleaned, report = VelocityProcessing.reject_outliers(lazy)
+    assert cleaned is not lazy and bool(lazy.v.notnull().all())
+    cleaned, report = dask.compute(cleaned, report)
+    assert int(report['negative_speed']) == 1
+    assert bool(cleaned.v[3, 2, 2].isnull()) and bool(cleaned.vx[3, 2, 2].isnull())
+
+    in_memory, in_memory_report = VelocityProcessing.reject_outliers(cube)
+    xr.testing.assert_equal(in_memory_report, report)
+    xr.testing.assert_equal(in_memory.v, cleaned.v)
+    assert bool(cube.v[3, 2, 2].isnull())
+
+
+def test_reject_outliers_keeps_slow_ice():
+    # Speeds of 1-4 m/yr rounded to whole m/yr like the granules, with errors larger than the speed
+    rng = np.random.default_rng(0)
+    angle = rng.uniform(0, 2 * np.pi, (6, 5, 5))
+    speed = rng.uniform(1, 4, angle.shape)
+    vx, vy = np.round(speed * np.cos(angle)), np.round(speed * np.sin(angle))
+    v, v_err = np.round(speed), np.full(angle.shape, 6.0)
+    # A fast pixel with a component and an error that don't match its speed
+    v[0, 0, 0], vx[0, 0, 0], vy[0, 0, 0] = 100, 50, 0
+    v[1, 0, 0], vx[1, 0, 0], vy[1, 0, 0], v_err[1, 0, 0] = 100, 100, 0, 150
+    cube = xr.Dataset({name: (('time', 'y', 'x'), data) for name, data in
+                       [('v', v), ('vx', vx), ('vy', vy), ('v_err', v_err)]})
+    cleaned, report = VelocityProcessing.reject_outliers(cube, mad_threshold=None)
+    assert int(report['consistency']) == 1 and int(report['relative_error']) == 1
+    assert int(report['total']) == 2 and int(cleaned.v.isnull().sum()) == 2
+
+
+def test_export_cube_keeps_the_crs(tmp_path):
+    time = pd.date_range('2015-01-01', periods=2, freq='30D')
+    cube = granule(-1716480.0, -209280.0).expand_dims(time=time).copy()
+    # Same layout as load_cube output, the CRS coordinate is not called spatial_ref
+    cube = cube.rio.write_crs(3031, grid_mapping_name='Polar_Stereographic')
+    cube = cube.assign_coords(date_dt=('time', [12.0, 24.0]))
+
+    VelocityProcessing.export_cube(cube, str(tmp_path / 'cube.nc'))
+    with xr.open_dataset(tmp_path / 'cube.nc') as exported:
+        assert exported.rio.crs.to_epsg() == 3031
+        assert 'Polar_Stereographic' in exported.coords and 'date_dt' in exported.coords
+        xr.testing.assert_equal(exported.v.drop_vars('Polar_Stereographic'), cube.v.drop_vars('Polar_Stereographic'))
+    VelocityProcessing.export_cube(cube, str(tmp_path / 'cube.zarr'), format='zarr')
+    assert xr.open_zarr(tmp_path / 'cube.zarr').rio.crs.to_epsg() == 3031
+    paths = VelocityProcessing.export_cube(cube, str(tmp_path / 'cog'), format='cog')
+    assert len(paths) == 2
+    for path in paths:
+        with rasterio.open(path) as cog:
+            assert cog.crs.to_epsg() == 3031